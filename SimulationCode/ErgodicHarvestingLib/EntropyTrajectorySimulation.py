@@ -17,7 +17,8 @@ from ErgodicHarvestingLib.save2mat import save2mat
 
 
 def TrajEIDSim(ergParam, eidParam, rawTraj, showMsg=True):
-    # Initialize the RNG with the provided seed
+    # Initialize the RNG with the provided seed, a per-job Generator rather than
+    # the global np.random state. Keep MT19937 so seeded runs stay reproducible
     rng = Generator(MT19937(eidParam.randSeed))
     # Initialize
     eid = EID(eidParam, rng)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from scipy.integrate import trapz, quad
+
+from ErgodicHarvestingLib.utils import trapz_uniform
 
 
 class Ergodicity(object):
@@ -12,6 +13,7 @@ class Ergodicity(object):
         self.wlimit = float(1)
         self.res = ergParam.res  # Spatial Resolution
         self.time = np.linspace(0.0, 1.0, self.res)
+        self.deltaT = self.time[1] - self.time[0]  # uniform time step
         self.xlist = np.linspace(0.0, 1.0, self.res)
         # set up a grid over the frequency
         klist = np.arange(self.Nfourier)
@@ -19,25 +21,22 @@ class Ergodicity(object):
         s = (float(self.dimw) + 1.0) / 2.0
         self.Lambdak = 1.0 / (1.0 + klist ** 2) ** s
         self.klist = klist / self.wlimit * np.pi
-        self.hk = np.zeros(self.Nfourier).flatten()
-        for index in range(self.Nfourier):
-            integ = quad(
-                lambda x: (np.cos(x * self.klist[index])) ** 2, 0, float(wlimit)
-            )
-            self.hk[index] = np.sqrt(integ[0])
+        # closed form of sqrt(int_0^wlimit cos(k x)^2 dx), sinc covers k = 0
+        self.hk = np.sqrt(
+            0.5 * wlimit * (1.0 + np.sinc(2.0 * self.klist * wlimit / np.pi))
+        )
+        # Fourier basis over the workspace grid, invariant across pdf updates
+        self.xlist_basis = np.cos(np.outer(self.klist, self.xlist))
 
     def normalize_pdf(self):
         # function to normalize a pdf
-        self.pdf /= np.sum(self.pdf) / np.product(self.pdf.shape)
+        self.pdf /= np.sum(self.pdf) / np.prod(self.pdf.shape)
 
     def calculate_uk(self, pdf):
         # calculate Fourier coefficients of the distribution
-        self.uk = np.zeros(self.Nfourier).flatten()
-        for index in range(len(self.uk)):
-            uk_interior = pdf / self.hk[index]
-            basis_part = np.cos(self.klist[index] * self.xlist)
-            uk_interior *= self.wlimit / self.res * basis_part
-            self.uk[index] = np.sum(uk_interior)
+        self.uk = (
+            np.sum(self.xlist_basis * pdf, axis=1) * (self.wlimit / self.res) / self.hk
+        )
 
     def setPDF(self, pdf):
         # input pdf
@@ -57,12 +56,8 @@ class Ergodicity(object):
         T = time[-1]
         # change coordinates from configuration to ergodic workspace
         W = X.flatten()
-        self.ck = np.zeros(self.Nfourier).flatten()
-        for index in range(len(self.ck)):
-            ck_interior = 1.0 / (self.hk[index] * T)
-            basis_part = np.cos(self.klist[index] * W)
-            ck_interior = ck_interior * basis_part
-            self.ck[index] = trapz(ck_interior, time)
+        basis = np.cos(np.outer(self.klist, W))
+        self.ck = trapz_uniform(basis, self.deltaT) / (self.hk * T)
 
     def computeErgMeasure(self, x, pdf):
         self.X_current = x
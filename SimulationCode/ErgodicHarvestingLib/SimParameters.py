@@ -48,8 +48,8 @@ class EIDParameters:
     tRes = 101  # Time resolution
 
     def __init__(self):
-        self.maxIter = np.int(np.ceil(self.maxT / (self.dt * self.tRes)))
+        self.maxIter = int(np.ceil(self.maxT / (self.dt * self.tRes)))
 
     def UpdateDeltaT(self, dt):
         self.dt = dt
-        self.maxIter = np.int(np.ceil(self.maxT / (self.dt * self.tRes)))
+        self.maxIter = int(np.ceil(self.maxT / (self.dt * self.tRes)))
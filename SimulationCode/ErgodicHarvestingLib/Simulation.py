@@ -17,7 +17,8 @@ from ErgodicHarvestingLib.save2mat import save2mat
 
 
 def EIDSim(ergParam, eidParam, showMsg=True):
-    # Initialize the RNG with the provided seed
+    # Initialize the RNG with the provided seed, a per-job Generator rather than
+    # the global np.random state. Keep MT19937 so seeded runs stay reproducible
     rng = Generator(MT19937(eidParam.randSeed))
     # Initialize
     eid = EID(eidParam, rng)
@@ -38,7 +39,7 @@ def EIDSim(ergParam, eidParam, showMsg=True):
         enpList = np.empty(eidParam.maxIter)
         pLast = np.ones([ergParam.res, 1])
     elif eidParam.simType == "IF":
-        eidParam.maxIter = np.int(np.round(eidParam.maxT / ergParam.dt))
+        eidParam.maxIter = int(np.round(eidParam.maxT / ergParam.dt))
         eidList = np.ones([eidParam.res, eidParam.maxIter])
         sTrajList = np.array([eidParam.sInitPos])
         oTrajList = np.empty(0)
@@ -1,15 +1,12 @@
+from functools import lru_cache
 from itertools import product
-from multiprocessing import Pool, JoinableQueue, get_context
+from multiprocessing import cpu_count, get_all_start_methods, get_context
 from queue import Empty
-from os import makedirs, getpid, remove
+from os import environ, makedirs, getpid
 from os.path import exists
 from numpy import linspace
 import numpy as np
 from scipy.io import loadmat
-import time
-import tempfile
-sim_jobs_path = tempfile.mkdtemp()
-import pickle as pkl
 
 from ErgodicHarvestingLib.Simulation import EIDSim
 from ErgodicHarvestingLib.EIH_API_Sim_Entropy import EIH_Sim
@@ -42,42 +39,83 @@ def normalize(s, t, mid=0.5, gain=0.1):
     return s, t
 
 
-def loadMothData(target="M300lux", trialID=0, nrmMid=0.5, nrmGain=0.1):
-    traj = flatten(
+@lru_cache(maxsize=4)
+def loadMothTrials(target="M300lux"):
+    # Raw trials are shared by all the jobs, only read the .mat file once
+    return flatten(
         loadmat(
             "../Production-Figure-Code/PublishedData/animal_behavior_data/Moth/MothData.mat"
         )[f"trial_{target}"]
-    )[trialID, :, :]
-    s, t = normalize(traj[:, 0], traj[:, 1], nrmMid, nrmGain)
+    )
+
+
+def loadMothData(target="M300lux", trialID=0, nrmMid=0.5, nrmGain=0.1):
+    traj = loadMothTrials(target)[trialID, :, :]
+    # normalize() works in place, keep the cached trials intact
+    s, t = normalize(traj[:, 0].copy(), traj[:, 1].copy(), nrmMid, nrmGain)
     return [s, t]
 
 
-def QueueWorker(mp_queue):
-    time.sleep(2.5)
+def simJobFilename(filename, simParam):
+    return (
+        filename.replace("SNR", "SNR-" + str(simParam[0]))
+        .replace("wC", "wC-" + str(simParam[6]))
+        .replace("RandSeed", "RandSeed-" + str(simParam[7]))
+    )
+
+
+def setupSimJob(param, simParam):
+    # Apply one permutation of the conditions to the trial parameters
+    eidParam = param["eidParam"]
+    ergParam = param["ergParam"]
+    eidParam.SNR = simParam[0]
+    eidParam.procNoiseSigma = simParam[1]
+    eidParam.pLSigmaAmp = simParam[2]
+    eidParam.pLSigmaAmpBayesian = simParam[2]
+    eidParam.pLSigmaAmpEID = simParam[2]
+    eidParam.Sigma = simParam[3]
+    eidParam.objAmp = simParam[4]
+    ergParam.dt = simParam[5]
+    eidParam.UpdateDeltaT(simParam[5])
+    if eidParam.simType == "IF":
+        eidParam.maxIter = round(eidParam.maxT / ergParam.dt)
+    ergParam.wControl = simParam[6]
+    eidParam.randSeed = simParam[7]
+    eidParam.filename = simJobFilename(param["filename"], simParam)
+    rawTraj = param["rawTraj"]
+    if isinstance(rawTraj, str) and "moth" in rawTraj:
+        eidParam.rawTraj = np.array(
+            loadMothData(target="M300lux", trialID=0, nrmGain=eidParam.objAmp)[1]
+        )
+    return ergParam, eidParam
+
+
+def QueueWorker(mp_queue, paramList, simParamList):
     while True:
         try:
-            job_path = mp_queue.get(block=True, timeout=30.0)
+            job = mp_queue.get(block=True, timeout=30.0)
             remaining_jobs = mp_queue.qsize()
-            with open(job_path, 'rb') as fp:
-                args = pkl.load(fp)
-            if args is None:
-                continue
-            remove(job_path)
             mp_queue.task_done()
-            if isinstance(args, list):
+            if job is None:
+                continue
+            if isinstance(job, list):
                 # wiggle attenuation sim
                 print_color(
-                    f"[WorkerNode-{getpid()}] Received new job {args[3]}, remaining jobs {remaining_jobs}",
+                    f"[WorkerNode-{getpid()}] Received new job {job[3]}, remaining jobs {remaining_jobs}",
                     color="yellow",
                 )
-                EIH_Sim(*args)
-            else:
-                # other sims
-                print_color(
-                    f"[WorkerNode-{getpid()}] Received new job {args[1].filename}, remaining jobs {remaining_jobs}",
-                    color="yellow",
-                )
-                EIDSim(*args)
+                EIH_Sim(*job)
+            elif job[0] == "batch":
+                # other sims, a batch of (trial, permutation) indices
+                for trial, it in job[1]:
+                    ergParam, eidParam = setupSimJob(
+                        paramList[trial], simParamList[trial][it]
+                    )
+                    print_color(
+                        f"[WorkerNode-{getpid()}] Received new job {eidParam.filename}, remaining jobs {remaining_jobs}",
+                        color="yellow",
+                    )
+                    EIDSim(ergParam, eidParam, False)
         except Empty:
             print_color(
                 f"[WorkerNode-{getpid()}] no more work to be done, existing",
@@ -115,111 +153,109 @@ def SimulationMainQueue(dataFiles, nThread=1):
         nSimJobsList.append(len(simParamList[-1]))
 
     nTrials = len(nSimJobsList)
+    for param in paramList:
+        eidParam = param["eidParam"]
+        ergParam = param["ergParam"]
+        # Check if saveDir exists, create the folder if not
+        if not exists(eidParam.saveDir):
+            print(f"Save folder {eidParam.saveDir} does not exist, creating...")
+            makedirs(eidParam.saveDir, exist_ok=True)
+        # Time grids only depend on the trial, not on the permutations
+        ergParam.time = linspace(0.0, ergParam.timeHorizon, ergParam.tRes)
+        ergParam.eidTime = linspace(0.0, ergParam.timeHorizon, eidParam.res)
+        # Keep the trajectory source, workers replace rawTraj per job
+        param["rawTraj"] = eidParam.rawTraj
+        # initialize multiple targets tracking
+        if eidParam.multiTargetTracking == "dual":
+            eidParam.multiTargetTracking = True
+            eidParam.otherTargets = [RealTarget(eidParam.multiTargetInitialPos)]
+        elif eidParam.multiTargetTracking == "distractor":
+            eidParam.multiTargetTracking = True
+            eidParam.otherTargets = [Distractor(eidParam.multiTargetInitialPos)]
+
     # additional wiggle attenuation sims
     with open("./SimParameters/SimJobList.txt", "r") as fp:
-        attenuation_sim_trials = fp.readlines()
+        # one job per non-empty line, so the job count matches what is queued
+        attenuation_sim_trials = [line.split() for line in fp if line.strip()]
         attenuation_sim_trials.sort()
     nAttenuationSimTrials = len(attenuation_sim_trials)
     nRegularSimJobs = sum(nSimJobsList)
     nTotalJobs = nRegularSimJobs + nAttenuationSimTrials
-    # Limit pool size when job size is smaller than total available threads
-    if nTotalJobs < nThread:
-        nThread = nTotalJobs
+    # Limit pool size when job size is smaller than total available threads,
+    # and never oversubscribe the available cores
+    nThread = min(nThread, nTotalJobs, cpu_count())
     # Start a new parallel pool
     print("Starting parallel pool with {0} threads".format(nThread))
-    ctx = get_context("fork")
-    pool = Pool(processes=nThread)
-    work_queue = JoinableQueue(maxsize=nTotalJobs)
+    # One BLAS/OpenMP thread per worker, the parallelism comes from the pool.
+    # Workers inherit this environment before they import numpy.
+    for var in [
+        "OMP_NUM_THREADS",
+        "OPENBLAS_NUM_THREADS",
+        "MKL_NUM_THREADS",
+        "VECLIB_MAXIMUM_THREADS",
+    ]:
+        environ[var] = "1"
+    if "forkserver" in get_all_start_methods():
+        # Workers are forked from a clean server process that has the
+        # simulation stack preloaded, instead of the (large) master process
+        ctx = get_context("forkserver")
+        ctx.set_forkserver_preload(
+            [
+                "numpy",
+                "scipy.integrate",
+                "scipy.interpolate",
+                "ErgodicHarvestingLib.SimulationMainQueue",
+            ]
+        )
+    else:
+        ctx = get_context("spawn")
+    # One pending job per worker is enough to keep them busy, the master
+    # blocks on put() until a worker frees a slot
+    work_queue = ctx.JoinableQueue(maxsize=nThread)
     jobs = []
     remaining_jobs = nTotalJobs
-    job_id = 1
-
-    for it in range(nAttenuationSimTrials):
-        job_path = f'{sim_jobs_path}/eih_sim_job_{job_id}.pkl'
-        with open(job_path, 'wb') as fp:
-            pkl.dump(attenuation_sim_trials[it].split(), fp, pkl.HIGHEST_PROTOCOL)
-        # Fill in work queue
-        work_queue.put(job_path, block=True, timeout=None)
-        job_id += 1
-        remaining_jobs -= 1
-        print_color(
-            f"[MasterNode-{getpid()}]: Adding new job {attenuation_sim_trials[it].split()[3]}",
-            color="green",
-        )
 
     # Kick off worker threads
     for _ in range(nThread):
         # Start a new job thread
-        try:
-            p = pool.Process(target=QueueWorker, args=(work_queue,))
-        except Exception:
-            if ctx is not None:
-                # Fallback to use context
-                p = ctx.Process(target=QueueWorker, args=(work_queue,))
+        # Trial parameters are shipped once per worker, jobs are just indices
+        p = ctx.Process(
+            target=QueueWorker, args=(work_queue, paramList, simParamList)
+        )
         p.start()
         jobs.append(p)
 
+    for it in range(nAttenuationSimTrials):
+        # Fill in work queue, blocks while the queue is full
+        work_queue.put(attenuation_sim_trials[it], block=True, timeout=None)
+        remaining_jobs -= 1
+        print_color(
+            f"[MasterNode-{getpid()}]: Adding new job {attenuation_sim_trials[it][3]}",
+            color="green",
+        )
+
+    # Hand out regular jobs in batches, a few batches per worker keeps the
+    # load balanced while amortizing the queue round trip
+    batchSize = max(1, nRegularSimJobs // (4 * nThread))
+    batch = []
     for trial in range(nTrials):
-        # Parse parameters
-        param = paramList[trial]
-        simParam = simParamList[trial]
-        nJobs = nSimJobsList[trial]
-        eidParam = param["eidParam"]
-        ergParam = param["ergParam"]
-        filename = param["filename"]
-        # Check if saveDir exists, create the folder if not
-        if not exists(eidParam.saveDir):
-            print(f"Save folder {eidParam.saveDir} does not exist, creating...")
-            makedirs(eidParam.saveDir, exist_ok=True)
-        ergParam.time = None
-        ergParam.eidTime = None
-        for it in range(nJobs):
-            eidParam.SNR = simParam[it][0]
-            eidParam.procNoiseSigma = simParam[it][1]
-            eidParam.pLSigmaAmp = simParam[it][2]
-            eidParam.pLSigmaAmpBayesian = simParam[it][2]
-            eidParam.pLSigmaAmpEID = simParam[it][2]
-            eidParam.Sigma = simParam[it][3]
-            eidParam.objAmp = simParam[it][4]
-            ergParam.dt = simParam[it][5]
-            eidParam.UpdateDeltaT(simParam[it][5])
-            if eidParam.simType == "IF":
-                eidParam.maxIter = round(eidParam.maxT / ergParam.dt)
-            ergParam.wControl = simParam[it][6]
-            eidParam.randSeed = simParam[it][7]
-            eidParam.filename = (
-                filename.replace("SNR", "SNR-" + str(eidParam.SNR))
-                .replace("wC", "wC-" + str(ergParam.wControl))
-                .replace("RandSeed", "RandSeed-" + str(eidParam.randSeed))
-            )
-            # Do the extra initialization here to speed up.
-            if isinstance(eidParam.rawTraj, str) and "moth" in eidParam.rawTraj:
-                eidParam.rawTraj = np.array(
-                    loadMothData(
-                        target="M300lux", trialID=0, nrmGain=eidParam.objAmp
-                    )[1]
-                )
-            ergParam.time = linspace(0.0, ergParam.timeHorizon, ergParam.tRes)
-            ergParam.eidTime = linspace(0.0, ergParam.timeHorizon, eidParam.res)
-            # initialize multiple targets tracking
-            if eidParam.multiTargetTracking == "dual":
-                eidParam.multiTargetTracking = True
-                eidParam.otherTargets = [RealTarget(eidParam.multiTargetInitialPos)]
-            elif eidParam.multiTargetTracking == "distractor":
-                eidParam.multiTargetTracking = True
-                eidParam.otherTargets = [Distractor(eidParam.multiTargetInitialPos)]
-
-            # Fill in work queue if it's not full
-            job_path = f'{sim_jobs_path}/eih_sim_job_{job_id}.pkl'
-            with open(job_path, 'wb') as fp:
-                pkl.dump((ergParam, eidParam, False), fp, pkl.HIGHEST_PROTOCOL)
-            work_queue.put(job_path, block=True, timeout=None)
-            job_id += 1
+        for it in range(nSimJobsList[trial]):
+            batch.append((trial, it))
             remaining_jobs -= 1
+            filename = simJobFilename(
+                paramList[trial]["filename"], simParamList[trial][it]
+            )
             print_color(
-                f"[MasterNode-{getpid()}]: Adding new job {eidParam.filename}",
+                f"[MasterNode-{getpid()}]: Adding new job {filename}",
                 color="green",
             )
+            if len(batch) == batchSize:
+                # Fill in work queue, blocks while the queue is full
+                work_queue.put(("batch", batch), block=True, timeout=None)
+                batch = []
+    if batch:
+        # leftover jobs in the last partial batch
+        work_queue.put(("batch", batch), block=True, timeout=None)
 
     # Wait until all the active thread to finish
     work_queue.join()
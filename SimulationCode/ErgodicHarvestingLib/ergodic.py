@@ -1,18 +1,59 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from scipy.integrate import trapz, quad, solve_ivp
 from scipy.interpolate import interp1d
 
-from ErgodicHarvestingLib.utils import matmult
+from ErgodicHarvestingLib.utils import matmult, interp_grid, rk4, trapz_uniform
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, fall back to the vectorized NumPy kernels
+    njit = None
+
+
+def ck_integral(klist, W, dt):
+    # int cos(k W(t)) dt over time for every k, trapezoidal rule
+    return trapz_uniform(np.cos(np.outer(klist, W)), dt)
+
+
+def ak_gradient(klist, W, outerchain):
+    # sum over k of outerchain_k * d/dW cos(k W(t)), for every t
+    basis = -klist[:, None] * np.sin(np.outer(klist, W))
+    return np.sum(outerchain[:, None] * basis, axis=0)
+
+
+if njit is not None:
+
+    @njit(cache=True, fastmath=True)
+    def ck_integral(klist, W, dt):
+        ck = np.zeros(klist.size)
+        for i in range(klist.size):
+            for j in range(W.size):
+                ck[i] += np.cos(klist[i] * W[j])
+            ck[i] -= 0.5 * (np.cos(klist[i] * W[0]) + np.cos(klist[i] * W[-1]))
+        return dt * ck
+
+    @njit(cache=True, fastmath=True)
+    def ak_gradient(klist, W, outerchain):
+        ak = np.zeros(W.size)
+        for j in range(W.size):
+            for i in range(klist.size):
+                ak[j] -= outerchain[i] * klist[i] * np.sin(klist[i] * W[j])
+        return ak
 
 
 class ProjectionBasedOpt(object):
     def __init__(self, nx, nu, R, time, Quinit):
         """
         Class to represent an optimization problem for a system with dynamic constraints.
+        The dynamics and Riccati equations are written for a scalar system.
         :nx dimension of state
         :nu dimension of the control
         """
+        if nx != 1 or nu != 1:
+            raise ValueError(
+                f"Only scalar systems are supported, got nx={nx}, nu={nu}"
+            )
 
         self.nx = nx  # Dimension of State   X
         self.nu = nu  # Dimension of Control U
@@ -28,83 +69,61 @@ class ProjectionBasedOpt(object):
         self.Rn = 1.0
         self.Qk = 1.0
         self.Rk = 1.0
+        self.riccati_cache = {}  # Riccati solutions keyed by (R, Q) weights
 
         self.time = time
+        self.deltaT = time[1] - time[0]  # uniform time step
 
-        odeDeltaT = time[1] - time[0]
-        self.odeParam = {
-            "method": "RK23",
-            "t_span": (time[0], time[-1]),
-            "rtol": 1e-4,
-            "atol": 1e-7,
-            "t_eval": time,
-            "min_step": odeDeltaT,
-            "first_step": odeDeltaT,
-            "max_step": odeDeltaT,
-        }
-        self.odeIntegrator = lambda fun, y0: solve_ivp(
-            fun, y0=y0, **self.odeParam
-        ).y.flatten()
+        # fixed-step integration on the time grid, one step per time point
+        # nx = 1, so the single state column is returned as a 1-D view
+        self.odeIntegrator = lambda fun, y0: rk4(fun, y0, self.time)[:, 0]
 
     def peqns(self, t, pp, Al, Bl, Rn, Qn):
         if t > self.time[-1] or t < self.time[0]:
             return 0
-        pp = np.array(pp).flatten()
-        pp = pp.reshape(self.nx, self.nx)
-        matdiffeq = (
-            matmult(pp, Al(t)) + matmult(Al(t), pp) - matmult(pp, Bl(t), Bl(t), pp) + Qn
-        )
-        return matdiffeq.flatten()
+        A = Al(t)
+        B = Bl(t)
+        return pp * A + A * pp - pp * B * B * pp + Qn
 
     def reqns(self, t, rr, Al, Bl, a, b, Psol, Rn, Qn):
         if t > self.time[-1] or t < self.time[0]:
             return np.array([0.0])
         t = self.time[-1] - t
-        matdiffeq = (
-            matmult((Al(t) - matmult(Bl(t), Bl(t), Psol(t))), rr)
-            + a(t)
-            - matmult(Psol(t), Bl(t), b(t))
-        )
-        return matdiffeq.flatten()
+        B = Bl(t)
+        P = Psol(t)
+        return (Al(t) - B * B * P) * rr + a(t) - P * B * b(t)
 
     def veqns(self, zz, Al, Bl, a, b, Psol, Rsol, Rn, Qn):
-        vmatdiffeq = matmult(-Bl, Psol, zz) - matmult(Bl, Rsol) - b
+        vmatdiffeq = -Bl * Psol * zz - Bl * Rsol - b
         return vmatdiffeq
 
     def zeqns(self, t, zz, Al, Bl, a, b, Psol, Rsol, Rn, Qn):
         if t > self.time[-1] or t < self.time[0]:
             return 0
-        vmateq = self.veqns(zz, Al(t), Bl(t).T, a(t), b(t), Psol(t), Rsol(t), Rn, Qn)
-        matdiffeq = matmult(Al(t), zz) + matmult(Bl(t), vmateq)
-        return matdiffeq.flatten()
+        B = Bl(t)
+        vmateq = self.veqns(zz, Al(t), B, a(t), b(t), Psol(t), Rsol(t), Rn, Qn)
+        return Al(t) * zz + B * vmateq
+
+    def riccatisol(self, Rn, Qn):
+        # Ksol and Psol solve the same Riccati equation when their weights
+        # match, only integrate it once per linearization
+        if (Rn, Qn) not in self.riccati_cache:
+            P1 = np.array([1.0])
+            soln = self.odeIntegrator(
+                lambda t, y: self.peqns(t, y, self.A_interp, self.B_interp, Rn, Qn),
+                P1,
+            ).reshape(-1, 1)
+            self.riccati_cache[(Rn, Qn)] = soln
+        return self.riccati_cache[(Rn, Qn)]
 
     def Ksol(self, X, U):
-        time = self.time
-        P1 = np.array([1.0])
-        soln = self.odeIntegrator(
-            lambda t, y: self.peqns(
-                t, y, self.A_interp, self.B_interp, self.Rk, self.Qk
-            ),
-            P1,
-        )
-        # Convert the list to a numpy array.
-        psoln = np.array(soln).reshape(len(soln), 1)
-        K = np.empty((time.shape[0], self.nx))
-        for tindex, t in np.ndenumerate(time):
-            K[tindex, :] = matmult(self.B_current[tindex, 0], psoln[tindex])
+        psoln = self.riccatisol(self.Rk, self.Qk)
+        K = self.B_current[:, 0:1] * psoln
         self.K = K
         return K
 
     def Psol(self, X, U, time):
-        P1 = np.array([1.0])
-        soln = self.odeIntegrator(
-            lambda t, y: self.peqns(
-                t, y, self.A_interp, self.B_interp, self.Rn, self.Qn
-            ),
-            P1,
-        )
-        soln = np.array(soln).reshape(len(soln), 1)
-        return soln
+        return self.riccatisol(self.Rn, self.Qn)
 
     def Rsol(self, X, U, P_interp, time):
         rinit2 = np.array([0])
@@ -124,9 +143,8 @@ class ProjectionBasedOpt(object):
             ),
             rinit2,
         )
-        soln = np.array(soln)
-        soln = np.flip(soln, 0).reshape(len(soln), 1)
-        return soln
+        # reversed view, callers only read it
+        return np.flip(soln, 0).reshape(-1, 1)
 
     # pointwise dynamics linearizations
     def fofx_pointwise(self, X, U):
@@ -141,10 +159,7 @@ class ProjectionBasedOpt(object):
         return np.array([0])
 
     def dfdx(self):
-        time = self.time
-        dfdxl = np.empty([time.shape[0], self.nx])
-        for tindex, _ in np.ndenumerate(time):
-            dfdxl[tindex, :] = np.array([0])
+        dfdxl = np.zeros([self.time.shape[0], self.nx])
         self.A_current = dfdxl
         return dfdxl
 
@@ -152,10 +167,7 @@ class ProjectionBasedOpt(object):
         return np.array([1])
 
     def dfdu(self):
-        time = self.time
-        dfdul = np.empty([time.shape[0], self.nx])
-        for tindex, _ in np.ndenumerate(time):
-            dfdul[tindex, :] = np.array([1])
+        dfdul = np.ones([self.time.shape[0], self.nx])
         self.B_current = dfdul
         return dfdul
 
@@ -164,10 +176,9 @@ class ProjectionBasedOpt(object):
         return 0.5 * matmult(u, R, u)
 
     def cost(self, X, U):
-        cost = np.empty(self.time.shape[0])
-        for tindex, _ in np.ndenumerate(self.time):
-            cost[tindex] = self.cost_pointwise(X[tindex], U[tindex])
-        return trapz(cost, self.time)  # Integrate over time
+        # pointwise 0.5 * u^T R u for every time step
+        cost = 0.5 * np.sum(matmult(U, self.R) * U, axis=1)
+        return trapz_uniform(cost, self.deltaT)  # Integrate over time
 
     def eval_cost(self):
         # return the evaluated cost function
@@ -183,23 +194,13 @@ class ProjectionBasedOpt(object):
 
     def dldx(self):
         # evaluate linearized cost WRT state
-        X = self.X_current
-        U = self.U_current
-        time = self.time
-        dldxl = np.empty((time.shape[0], self.nx))
-        for tindex, _ in np.ndenumerate(time):
-            dldxl[tindex, :] = self.dldx_pointwise(X[tindex], U[tindex])
+        dldxl = np.zeros((self.time.shape[0], self.nx))
         self.a_current = dldxl
         return self.a_current
 
     def dldu(self):
         # evaluate linearized cost WRT input
-        X = self.X_current
-        U = self.U_current
-        time = self.time
-        dldul = np.empty((time.shape[0], 1))
-        for tindex, _ in np.ndenumerate(time):
-            dldul[tindex, :] = self.dldu_pointwise(X[tindex], U[tindex])
+        dldul = matmult(self.U_current, self.R.T)
         dldul[0, :] += self.uinit * self.Quinit  # initial control
         self.b_current = dldul
         return dldul
@@ -208,13 +209,8 @@ class ProjectionBasedOpt(object):
         # evaluate directional derivative
         dX = descdir[0]
         dU = descdir[1]
-        time = self.time
-        dc = np.empty(time.shape[0])
-        for tindex, _ in np.ndenumerate(time):
-            dc[tindex] = matmult(self.a_current[tindex], dX[tindex]) + matmult(
-                self.b_current[tindex], dU[tindex]
-            )
-        intdcost = trapz(dc, time)
+        dc = np.sum(self.a_current * dX, axis=1) + np.sum(self.b_current * dU, axis=1)
+        intdcost = trapz_uniform(dc, self.deltaT)
         return intdcost
 
     def descentdirection(self):
@@ -224,12 +220,12 @@ class ProjectionBasedOpt(object):
         time = self.time
         Ps = self.Psol(X, U, time)
         self.P_current = Ps
-        P_interp = interp1d(time, Ps.T)
+        P_interp = interp_grid(time, Ps)
         Rs = self.Rsol(X, U, P_interp, time).flatten()
         self.R_current = Rs
-        r_interp = interp1d(time, Rs.T)
+        r_interp = interp_grid(time, Rs)
 
-        zinit = -matmult(P_interp(0) ** -1, r_interp(0))
+        zinit = -matmult(Ps[0] ** -1, Rs[0])
         soln = self.odeIntegrator(
             lambda t, y: self.zeqns(
                 t,
@@ -245,43 +241,34 @@ class ProjectionBasedOpt(object):
             ),
             zinit,
         )
-        # Convert the list to a numpy array.
-        zsoln = np.array(soln)
-        zsoln = zsoln.reshape(time.shape[0], 1)
-        vsoln = np.empty(U.shape)
-        for tindex, t in np.ndenumerate(time):
-            vsoln[tindex] = self.veqns(
-                zsoln[tindex],
-                self.A_current[tindex],
-                self.B_current[tindex],
-                self.a_current[tindex],
-                self.b_current[tindex],
-                Ps[tindex],
-                Rs[tindex],
-                self.Rn,
-                self.Qn,
-            )
+        zsoln = soln.reshape(-1, 1)
+        vsoln = self.veqns(
+            zsoln,
+            self.A_current,
+            self.B_current,
+            self.a_current,
+            self.b_current,
+            Ps,
+            Rs.reshape(Rs.size, 1),
+            self.Rn,
+            self.Qn,
+        )
         return [zsoln, vsoln]
 
     def simulate(self, X0, U):
         time = self.time
-        U_interp = interp1d(time, U.T)
+        U_interp = interp_grid(time, U)
         # Solve ODE
-        soln = self.odeIntegrator(lambda t, y: self.fofx(t, y, U_interp), X0)
-        # Convert the list to a numpy array.
-        xsoln = np.array(soln).reshape(len(soln), 1)
-        return xsoln
+        xsoln = self.odeIntegrator(lambda t, y: self.fofx(t, y, U_interp), X0)
+        return xsoln.reshape(-1, 1)
 
     def proj(self, t, X, K, mu, alpha):
-        if type(X) is float:
-            X = np.array(X)
         if t > self.time[-1] or t < self.time[0]:
             return 0
-        uloc = mu(t) + matmult(K(t), (alpha(t).T - X.T))
-        return uloc
+        return self.projcontrol(X, K(t), mu(t), alpha(t))
 
     def projcontrol(self, X, K, mu, alpha):
-        uloc = mu + matmult(K, (alpha.T - X.T))
+        uloc = mu + K * (alpha - X)
         return uloc
 
     def project(self, X0, traj):
@@ -291,20 +278,14 @@ class ProjectionBasedOpt(object):
 
         # solve for riccatti gain
         Ks = self.Ksol(alpha, mu)
-        K_interp = interp1d(time, Ks.T)
-        mu_interp = interp1d(time, mu.T)
-        alpha_interp = interp1d(time, alpha.T)
+        K_interp = interp_grid(time, Ks)
+        mu_interp = interp_grid(time, mu)
+        alpha_interp = interp_grid(time, alpha)
         # Solve ODE
-        soln = self.odeIntegrator(
+        xsoln = self.odeIntegrator(
             lambda t, y: self.proj(t, y, K_interp, mu_interp, alpha_interp), X0
-        )
-        # Convert the list to a numpy array.
-        xsoln = np.array(soln).reshape(len(soln), 1)
-        usoln = np.empty(mu.shape)
-        for tindex, _ in np.ndenumerate(time):
-            usoln[tindex, :] = self.projcontrol(
-                xsoln[tindex], Ks[tindex], mu[tindex], alpha[tindex]
-            )
+        ).reshape(-1, 1)
+        usoln = self.projcontrol(xsoln, Ks, mu, alpha)
         return np.array([xsoln, usoln])
 
     def update_traj(self, X, U):
@@ -314,10 +295,12 @@ class ProjectionBasedOpt(object):
         self.dfdu()
         self.dldx()
         self.dldu()
-        self.A_interp = interp1d(self.time, self.A_current.T)
-        self.B_interp = interp1d(self.time, self.B_current.T)
-        self.a_interp = interp1d(self.time, self.a_current.T)
-        self.b_interp = interp1d(self.time, self.b_current.T)
+        self.A_interp = interp_grid(self.time, self.A_current)
+        self.B_interp = interp_grid(self.time, self.B_current)
+        self.a_interp = interp_grid(self.time, self.a_current)
+        self.b_interp = interp_grid(self.time, self.b_current)
+        # A and B changed, drop the Riccati solutions
+        self.riccati_cache = {}
 
 
 class ErgodicOpt(ProjectionBasedOpt):
@@ -343,14 +326,14 @@ class ErgodicOpt(ProjectionBasedOpt):
         s = (float(self.dimw) + 1.0) / 2.0
         self.Lambdak = 1.0 / (1.0 + klist ** 2) ** s
         self.klist = klist / self.wlimit * np.pi
-        self.hk = np.zeros(self.Nfourier).flatten()
-        for index in range(self.Nfourier):
-            integ = quad(lambda x: (np.cos(x * self.klist[index])) ** 2, 0.0, 1.0)
-            self.hk[index] = np.sqrt(integ[0])
+        # closed form of sqrt(int_0^1 cos(k x)^2 dx), sinc covers k = 0
+        self.hk = np.sqrt(0.5 * (1.0 + np.sinc(2.0 * self.klist / np.pi)))
+        # Fourier basis over the workspace grid, invariant across pdf updates
+        self.xlist_basis = np.cos(np.outer(self.klist, self.xlist))
 
     def normalize_pdf(self):
         # function to normalize a pdf
-        self.pdf /= np.sum(self.pdf) / np.product(self.pdf.shape)
+        self.pdf /= np.sum(self.pdf) / np.prod(self.pdf.shape)
 
     def set_pdf(self, pdf):
         # input pdf
@@ -366,33 +349,25 @@ class ErgodicOpt(ProjectionBasedOpt):
         return self.erg
 
     def barrier(self, xk):
-        barr_cost = np.zeros(xk.shape[0])
         xk = xk.flatten()
-        too_big = xk[np.where(xk > self.wlimit)]
-        barr_cost[np.where(xk > self.wlimit)] = np.square(too_big - self.wlimit)
-        too_small = xk[np.where(xk < 0)]
-        barr_cost[np.where(xk < 0)] += np.square(too_small)
-        barr_cost = trapz(barr_cost, self.time)
+        # distance outside of the workspace [0, wlimit], zero inside
+        too_big = np.maximum(xk - self.wlimit, 0.0)
+        too_small = np.minimum(xk, 0.0)
+        barr_cost = trapz_uniform(too_big ** 2 + too_small ** 2, self.deltaT)
         return barr_cost
 
     def Dbarrier(self, xk):
         xk = xk.flatten()
-        dbarr_cost = np.zeros(xk.shape).reshape(xk.size, 1)
-        too_big = xk[np.where(xk > self.wlimit)]
-        dbarr_cost[np.where(xk > self.wlimit), 0] = 2.0 * (too_big - self.wlimit)
-        too_small = xk[np.where(xk < 0)]
-        dbarr_cost[np.where(xk < 0), 0] = 2.0 * too_small
-
-        return dbarr_cost
+        too_big = np.maximum(xk - self.wlimit, 0.0)
+        too_small = np.minimum(xk, 0.0)
+        dbarr_cost = 2.0 * (too_big + too_small)
+        return dbarr_cost.reshape(xk.size, 1)
 
     def calculate_uk(self, pdf):
         # calculate Fourier coefficients of the distribution
-        self.uk = np.zeros(self.Nfourier).flatten()
-        for index in range(len(self.uk)):
-            uk_interior = pdf / self.hk[index]
-            basis_part = np.cos(self.klist[index] * self.xlist)
-            uk_interior *= self.wlimit / self.res * basis_part
-            self.uk[index] = np.sum(uk_interior)
+        self.uk = (
+            np.sum(self.xlist_basis * pdf, axis=1) * (self.wlimit / self.res) / self.hk
+        )
 
     def ckeval(self):
         X = self.X_current
@@ -400,12 +375,7 @@ class ErgodicOpt(ProjectionBasedOpt):
         T = time[-1]
         # change coordinates from configuration to ergodic workspace
         W = X.flatten()
-        self.ck = np.zeros(self.Nfourier).flatten()
-        for index in range(len(self.ck)):
-            ck_interior = 1.0 / (self.hk[index] * T)
-            basis_part = np.cos(self.klist[index] * W)
-            ck_interior = ck_interior * basis_part
-            self.ck[index] = trapz(ck_interior, time)
+        self.ck = ck_integral(self.klist, W, self.deltaT) / (self.hk * T)
 
     def akeval(self):
         X = self.X_current
@@ -413,15 +383,9 @@ class ErgodicOpt(ProjectionBasedOpt):
         T = time[-1]
         xlist = X.flatten()
         outerchain = 2.0 * self.Lambdak * (self.ck - self.uk) / (self.hk * T)
-        ak = []
-        for index in range(self.Nfourier):
-            # these are chain rule terms, get added
-            term = outerchain[index]
-            basis_part = -self.klist[index] * np.sin(self.klist[index] * xlist)
-            term *= basis_part
-            ak.append(term)
-        summed_ak = np.sum(np.array(ak), axis=0)
-        self.ak = np.array(summed_ak).reshape(summed_ak.size, 1)
+        # these are chain rule terms, get added
+        summed_ak = ak_gradient(self.klist, xlist, outerchain)
+        self.ak = summed_ak.reshape(summed_ak.size, 1)
         return self.ak
 
     def evalcost(self):
@@ -445,7 +409,9 @@ class ErgodicOpt(ProjectionBasedOpt):
         self.dfdu()
         self.dldx()
         self.dldu()
-        self.A_interp = interp1d(self.time, self.A_current.T)
-        self.B_interp = interp1d(self.time, self.B_current.T)
-        self.a_interp = interp1d(self.time, self.a_current.T)
-        self.b_interp = interp1d(self.time, self.b_current.T)
+        self.A_interp = interp_grid(self.time, self.A_current)
+        self.B_interp = interp_grid(self.time, self.B_current)
+        self.a_interp = interp_grid(self.time, self.a_current)
+        self.b_interp = interp_grid(self.time, self.b_current)
+        # A and B changed, drop the Riccati solutions
+        self.riccati_cache = {}
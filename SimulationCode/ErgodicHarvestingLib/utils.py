@@ -11,6 +11,42 @@ def matmult(*x):
     return reduce(np.dot, x)
 
 
+def interp_grid(x, y):
+    """
+    Linear interpolant of a scalar signal y sampled on the grid x.
+    Cheaper drop-in for interp1d(x, y.T) inside ODE right-hand sides.
+    """
+    y = np.asarray(y).flatten()
+    return lambda t: np.interp(t, x, y)
+
+
+def trapz_uniform(y, dt):
+    """
+    Trapezoidal integral of y along its last axis, sampled with a uniform step dt.
+    """
+    return dt * (np.sum(y, axis=-1) - 0.5 * (y[..., 0] + y[..., -1]))
+
+
+def rk4(fun, y0, t):
+    """
+    Fixed-step 4th order Runge-Kutta integrator over the time grid t.
+    Returns the solution at every point of t, shape (len(t), len(y0)).
+    """
+    y = np.array(y0, dtype=float).flatten()
+    soln = np.empty((t.size, y.size))
+    soln[0] = y
+    for idx in range(t.size - 1):
+        dt = t[idx + 1] - t[idx]
+        tm = t[idx] + 0.5 * dt
+        k1 = fun(t[idx], y)
+        k2 = fun(tm, y + 0.5 * dt * k1)
+        k3 = fun(tm, y + 0.5 * dt * k2)
+        k4 = fun(t[idx + 1], y + dt * k3)
+        y = y + dt / 6.0 * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+        soln[idx + 1] = y
+    return soln
+
+
 def cartesian(arrays, out=None):
     """
     Generate a cartesian product of input arrays.